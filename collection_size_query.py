@@ -1,7 +1,10 @@
 # /// script
 # requires-python = ">=3.12,<3.13"
 # dependencies = [
-#     "httpx",
+#     "aiolimiter",
+#     "httpx[http2]",
+#     "orjson",
+#     "tenacity",
 # ]
 # ///
 
@@ -15,13 +18,23 @@ The `.env` sets the `SERVER_ROOT`, for production is `SERVER_ROOT="https://repos
 The API url is public; the reason for the `.env` is to make dev testing easier.
 """
 
+import asyncio
 import logging
+import math
 import os
+import re
+import sqlite3
 import sys
 import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
 from typing import Any
 
 import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 level: int = logging.DEBUG if os.getenv('LOG_LEVEL') == 'DEBUG' else logging.INFO  # 10 (debug) or 20 (info)
 logging.basicConfig(
@@ -33,20 +46,120 @@ log: logging.Logger = logging.getLogger(__name__)
 
 
 ## constants
-SLEEP_TIME: float = 0.5  # seconds to sleep between requests
+SLEEP_TIME: float = 0.5  # seconds between item-count requests; sets the shared rate-limit
 MIN_ITEMS_CONSIDERED_SMALL: int = 5  # min items for a collection to be considered small
 MAX_ITEMS_CONSIDERED_SMALL: int = 50  # max items in a collection to consider it small
 COLLECTIONS_PER_BATCH_SIZE: int = 100  # collections per batch
 MAX_COLLECTIONS_TO_CHECK: int = 200  # max collections to check
 COLLECTIONS_TO_GATHER_SIZE: int = 20  # number of collections to gather
+MAX_CONNECTIONS: int = 20  # max pooled (keep-alive) connections to the server; also caps count-request concurrency
+INITIAL_CONCURRENCY: int = 4  # starting number of concurrent item-count requests
+TARGET_P95_LATENCY: float = 2.0  # seconds; concurrency grows only while p95 item-count latency is under this
+CONNECT_RETRIES: int = 3  # transport-level retries for failed connections
+MAX_FETCH_ATTEMPTS: int = 4  # attempts per request for transient (timeout, 429, 5xx) errors
+RETRYABLE_STATUS_CODES: frozenset[int] = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUS_CODES: frozenset[int] = frozenset({429, 503})  # responses that shrink count-request concurrency
+COUNT_QUERY_TEMPLATE: Callable[[str], str] = 'rel_is_member_of_collection_ssim:"{}"'.format  # per-collection query
+COUNT_PARAMS_BASE: dict[str, str] = {'rows': '0', 'omitHeader': 'true'}  # per-collection params, minus `q`
+FACET_COUNT_PARAMS: dict[str, str] = {  # all-collections faceted count params
+    'q': '*:*',
+    'rows': '0',
+    'facet': 'true',
+    'facet.field': 'rel_is_member_of_collection_ssim',
+    'facet.mincount': '1',
+    'facet.limit': '-1',
+    'json.nl': 'flat',  # facet list as `[id, count, id, count, ...]`
+}
+NUM_FOUND_PATTERN: re.Pattern[bytes] = re.compile(rb'"numFound"\s*:\s*(\d+)')  # solr hit-count in a raw response
+COUNT_CACHE_PATH: Path = Path.home() / '.cache' / 'collection_size_query' / 'counts.db'  # per-collection count cache
+COUNT_CACHE_TTL: float = 24 * 60 * 60  # seconds a cached item count stays valid
 
 
-def fetch_collections_batch(client: httpx.Client, server_root: str, start: int) -> list[dict[str, str | None]]:
+@dataclass(slots=True)
+class CollectionInfo:
+    """
+    A small collection found by find_small_collections(): its ID, name (if any), and item count.
+    """
+
+    id: str
+    name: str | None
+    count: int
+
+
+def open_count_cache(cache_path: Path) -> sqlite3.Connection:
+    """
+    Opens (creating if needed) the on-disk sqlite cache of per-collection item counts.
+    Counts are keyed by server-root and collection ID, and stored with the time they were fetched.
+
+    Called by find_small_collections() manager.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache: sqlite3.Connection = sqlite3.connect(cache_path)
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS counts ('
+        'server_root TEXT, collection_id TEXT, count INTEGER, fetched_at REAL, '
+        'PRIMARY KEY (server_root, collection_id))'
+    )
+    return cache
+
+
+def get_cached_count(cache: sqlite3.Connection, server_root: str, collection_id: str) -> int | None:
+    """
+    Returns the cached item count for the given collection, or None if it's not cached or older than `COUNT_CACHE_TTL`.
+
+    Called by fetch_collection_item_count_cached().
+    """
+    row: tuple[int, float] | None = cache.execute(
+        'SELECT count, fetched_at FROM counts WHERE server_root = ? AND collection_id = ?',
+        (server_root, collection_id),
+    ).fetchone()
+    if row is None or time.time() - row[1] >= COUNT_CACHE_TTL:
+        return None
+    return row[0]
+
+
+def store_cached_count(cache: sqlite3.Connection, server_root: str, collection_id: str, count: int) -> None:
+    """
+    Saves the item count for the given collection, stamped with the current time.
+    Doesn't commit; check_batch_item_counts() commits once per wave, keeping disk syncs off the per-request path.
+
+    Called by fetch_collection_item_count_cached().
+    """
+    cache.execute(
+        'INSERT OR REPLACE INTO counts (server_root, collection_id, count, fetched_at) VALUES (?, ?, ?, ?)',
+        (server_root, collection_id, count, time.time()),
+    )
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    Returns True for transient errors worth retrying: transport-level errors (timeouts, dropped connections),
+    and HTTP responses with a status code in `RETRYABLE_STATUS_CODES`.
+
+    Called by the `fetch_retry` decorator.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+## retries transient errors with exponential backoff; tenacity awaits `asyncio.sleep()` between async attempts
+fetch_retry = retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_exponential(multiplier=SLEEP_TIME, max=10),
+    stop=stop_after_attempt(MAX_FETCH_ATTEMPTS),
+    reraise=True,
+)
+
+
+@fetch_retry
+async def fetch_collections_batch(client: httpx.AsyncClient, server_root: str, start: int) -> list[dict[str, str | None]]:
     """
     Retrieves a single batch (page) of collection summaries from the collections API endpoint.
     The batch is determined by the `start` offset and COLLECTIONS_PER_BATCH_SIZE.
+    Requests only the 'id' and 'name' fields, since nothing else is used.
     Returns a list of dictionaries, each containing at least 'id' and possibly 'name' for a collection.
-    Raises for HTTP errors.
+    Retries transient errors; raises for other HTTP errors, or once retries are exhausted.
 
     Returns a list of collection-info dictionaries.
 
@@ -57,90 +170,291 @@ def fetch_collections_batch(client: httpx.Client, server_root: str, start: int)
     params: dict[str, str] = {
         'rows': str(COLLECTIONS_PER_BATCH_SIZE),
         'start': str(start),
+        'fl': 'id,name',  # only the fields used; trims the response payload
     }
-    resp: httpx.Response = client.get(url, params=params, timeout=10)
+    resp: httpx.Response = await client.get(url, params=params, timeout=10)
     resp.raise_for_status()
-    data: dict[str, Any] = resp.json()
+    log.debug(f'collections batch response size, ``{len(resp.content)}`` bytes')
+    data: dict[str, Any] = orjson.loads(resp.content)
     collections_data: list[dict[str, str | None]] = data.get('collections', [])
     return collections_data
 
 
-def fetch_collection_item_count(
-    client: httpx.Client,
+@fetch_retry
+async def fetch_collection_item_count(
+    client: httpx.AsyncClient,
+    limiter: AsyncLimiter,
     server_root: str,
     collection_id: str,
+    throttle_events: list[str],
 ) -> int | None:
     """
     Submits a query to the search API for the given collection ID to retrieve the number of items in that collection.
+    The request waits on the shared `limiter`, so concurrent calls still honor the overall request-rate cap.
+    Appends the collection ID to `throttle_events` for every attempt answered with a `THROTTLE_STATUS_CODES` status,
+    so throttling is seen even when a retry later succeeds.
     Returns the item count as an integer, or None if not present in the response.
-    Raises for HTTP errors.
+    Retries transient errors; raises for other HTTP errors, or once retries are exhausted.
 
-    Called by find_small_collections() manager.
+    Called by fetch_collection_item_count_cached().
     """
-    q: str = f'rel_is_member_of_collection_ssim:"{collection_id}"'
     url: str = f'{server_root}/api/search/'
-    params: dict[str, str] = {'q': q, 'rows': '0'}
-    resp: httpx.Response = client.get(url, params=params, timeout=10)
+    params: dict[str, str] = COUNT_PARAMS_BASE | {'q': COUNT_QUERY_TEMPLATE(collection_id)}
+    async with limiter:
+        resp: httpx.Response = await client.get(url, params=params, timeout=10)
+    if resp.status_code in THROTTLE_STATUS_CODES:
+        throttle_events.append(collection_id)
     resp.raise_for_status()
-    data: dict[str, Any] = resp.json()
-    item_count: int | None = data.get('response', {}).get('numFound')
+    ## with rows=0 and no header, `numFound` appears once; scanning for it skips parsing the whole body
+    match: re.Match[bytes] | None = NUM_FOUND_PATTERN.search(resp.content)
+    item_count: int | None = int(match.group(1)) if match else None
     # log.info(f'item_count, ``{item_count}``')
     return item_count
 
 
-def find_small_collections(server_root: str) -> list[dict[str, str | int | None]]:
+async def fetch_collection_item_count_cached(
+    client: httpx.AsyncClient,
+    limiter: AsyncLimiter,
+    cache: sqlite3.Connection | None,
+    server_root: str,
+    collection_id: str,
+    throttle_events: list[str],
+) -> int | None:
+    """
+    Returns the item count for the given collection from the on-disk cache if it's still fresh;
+    otherwise fetches it via fetch_collection_item_count() and caches the result.
+    With no `cache` (it couldn't be opened), always fetches.
+
+    Called by check_batch_item_counts().
+    """
+    item_count: int | None = get_cached_count(cache, server_root, collection_id) if cache is not None else None
+    if item_count is not None:
+        log.debug(f'using cached count for ``{collection_id}``')
+        return item_count
+    item_count = await fetch_collection_item_count(client, limiter, server_root, collection_id, throttle_events)
+    if item_count is not None and cache is not None:
+        store_cached_count(cache, server_root, collection_id, item_count)
+    return item_count
+
+
+@fetch_retry
+async def fetch_all_collection_counts(client: httpx.AsyncClient, server_root: str) -> dict[str, int] | None:
+    """
+    Submits a single faceted query to the search API to retrieve the item counts for all collections at once.
+    Parses the flat Solr facet list (`[id, count, id, count, ...]`) into a dict of collection-id to item count.
+    Collections with no items are not listed.
+    Returns None if the response contains no facet data, or facet data of an unexpected shape,
+    so the caller can fall back to per-collection queries.
+    Retries transient errors; raises for other HTTP errors, or once retries are exhausted.
+
+    Called by find_small_collections() manager.
+    """
+    log.info('Fetching item counts for all collections')
+    url: str = f'{server_root}/api/search/'
+    params: dict[str, str] = FACET_COUNT_PARAMS
+    resp: httpx.Response = await client.get(url, params=params, timeout=10)
+    resp.raise_for_status()
+    data: Any = orjson.loads(resp.content)
+    ## guard each level; an unexpectedly-shaped response means falling back, not crashing
+    facet_counts: Any = data.get('facet_counts') if isinstance(data, dict) else None
+    facet_fields: Any = facet_counts.get('facet_fields') if isinstance(facet_counts, dict) else None
+    facet_list: Any = facet_fields.get('rel_is_member_of_collection_ssim') if isinstance(facet_fields, dict) else None
+    if not isinstance(facet_list, list):
+        return None
+    all_counts: dict[str, int] = dict(zip(facet_list[::2], facet_list[1::2]))
+    log.debug(f'facet counts returned for ``{len(all_counts)}`` collections')
+    return all_counts
+
+
+def evaluate_collection_count(
+    summary: dict[str, str | None],
+    count: int | None,
+    results: list[CollectionInfo],
+) -> None:
+    """
+    Logs the item count for the given collection summary, and appends the collection's ID, name, and count
+    to `results` if the count is between `MIN_ITEMS_CONSIDERED_SMALL` and `MAX_ITEMS_CONSIDERED_SMALL` (inclusive).
+
+    Called by find_small_collections() manager, and by check_batch_item_counts().
+    """
+    collection_id: str = summary['id']
+    if count is None:
+        log.warning(f'No count returned for {collection_id}')
+        return
+    log.info(f'Collection {collection_id}: {count} items')
+    if MIN_ITEMS_CONSIDERED_SMALL <= count <= MAX_ITEMS_CONSIDERED_SMALL:
+        result: CollectionInfo = CollectionInfo(id=collection_id, name=summary.get('name'), count=count)
+        results.append(result)
+        log.info(f'Collection {collection_id} added to results (count: {count})')
+
+
+def adjust_concurrency(concurrency: int, latencies: list[float], throttled: bool) -> int:
+    """
+    Returns the concurrency limit for the next wave of item-count requests.
+    Halves it if the server throttled (`THROTTLE_STATUS_CODES`) any attempt in the last wave; otherwise grows it by one
+    while the wave's p95 request latency stays under `TARGET_P95_LATENCY`, up to `MAX_CONNECTIONS`.
+    That latency includes time queued on the rate-limiter, so throttling is the shrink signal for the server itself.
+
+    Called by check_batch_item_counts().
+    """
+    if throttled:
+        new_concurrency: int = max(1, concurrency // 2)
+    elif latencies and sorted(latencies)[math.ceil(0.95 * len(latencies)) - 1] < TARGET_P95_LATENCY:
+        new_concurrency = min(MAX_CONNECTIONS, concurrency + 1)
+    else:
+        new_concurrency = concurrency
+    log.debug(f'concurrency, ``{concurrency}`` -> ``{new_concurrency}``')
+    return new_concurrency
+
+
+async def check_batch_item_counts(
+    client: httpx.AsyncClient,
+    limiter: AsyncLimiter,
+    cache: sqlite3.Connection | None,
+    server_root: str,
+    batch: list[dict[str, str | None]],
+    results: list[CollectionInfo],
+    concurrency: int,
+) -> tuple[int, int]:
+    """
+    Issues the per-collection item-count requests for a batch in concurrent waves of `concurrency` requests,
+    evaluating them in listing order, as each earlier-listed request settles, so the matches gathered are the same
+    as a serial scan's. After each wave the limit is adjusted via adjust_concurrency().
+    Counts still fresh in the on-disk cache are used without a request; newly fetched counts are committed per wave.
+    Once `COLLECTIONS_TO_GATHER_SIZE` results are gathered, cancels the requests listed after the cutoff.
+    Logs and skips collections whose request fails.
+
+    Returns the number of collections checked, and the concurrency limit for the next batch.
+
+    Called by find_small_collections() manager, when faceted counts are unavailable.
+    """
+    checked: int = 0
+    remaining: list[dict[str, str | None]] = list(batch)
+    while remaining and len(results) < COLLECTIONS_TO_GATHER_SIZE:
+        wave: list[dict[str, str | None]] = remaining[:concurrency]
+        remaining = remaining[concurrency:]
+        wave_start: float = time.perf_counter()
+        finished_at: dict[asyncio.Task[int | None], float] = {}
+        throttle_events: list[str] = []
+        wave_tasks: list[tuple[dict[str, str | None], asyncio.Task[int | None]]] = []
+        for summary in wave:
+            task: asyncio.Task[int | None] = asyncio.create_task(
+                fetch_collection_item_count_cached(client, limiter, cache, server_root, summary['id'], throttle_events)
+            )
+            task.add_done_callback(lambda done, stamps=finished_at: stamps.setdefault(done, time.perf_counter()))
+            wave_tasks.append((summary, task))
+        evaluated: int = 0
+        try:
+            for summary, task in wave_tasks:
+                if len(results) >= COLLECTIONS_TO_GATHER_SIZE:
+                    break
+                evaluated += 1
+                checked += 1
+                try:
+                    count: int | None = await task
+                except Exception as e:
+                    log.error(f'Error processing collection {summary["id"]}: {str(e)}')
+                    continue
+                evaluate_collection_count(summary, count, results)
+        finally:
+            ## stop requests listed after the cutoff (and collect any already-finished but unevaluated ones)
+            unevaluated: list[asyncio.Task[int | None]] = [task for _, task in wave_tasks[evaluated:]]
+            for task in unevaluated:
+                task.cancel()
+            await asyncio.gather(*unevaluated, return_exceptions=True)
+            if cache is not None:
+                cache.commit()
+        latencies: list[float] = [
+            finished_at.get(task, time.perf_counter()) - wave_start for _, task in wave_tasks[:evaluated]
+        ]
+        if throttle_events:
+            log.info(f'Server throttled ``{len(throttle_events)}`` count request(s) in the last wave')
+        concurrency = adjust_concurrency(concurrency, latencies, bool(throttle_events))
+    return checked, concurrency
+
+
+async def find_small_collections(server_root: str) -> list[CollectionInfo]:
     """
     Manager function.
 
-    Iterates through batches of collections, checking up to `max_to_check` collections,
-    and finds those with an item count between `min_items` and `max_items` (inclusive).
-    Stops after finding more than `COLLECTIONS_TO_GATHER_SIZE` matches or reaching the check limit.
+    Iterates through batches of collections, checking up to `MAX_COLLECTIONS_TO_CHECK` collections,
+    and finds those with an item count between `MIN_ITEMS_CONSIDERED_SMALL` and `MAX_ITEMS_CONSIDERED_SMALL` (inclusive).
+    Stops once `COLLECTIONS_TO_GATHER_SIZE` matches are found or the check limit is reached.
     For each qualifying collection, includes its ID, name, and item count in the result.
-    Sleeps between item count requests to avoid overloading the server.
+    Item counts come from a single faceted search query; if that's unavailable, falls back to
+    per-collection item-count requests, issued in adaptively-sized concurrent waves and cached on disk for `COUNT_CACHE_TTL`.
+    Those share a rate-limiter (`1 / SLEEP_TIME` requests per second) to avoid overloading the server.
+    The next batch of collections is prefetched while the current batch is being checked.
+    Requests share a pooled HTTP/2 client, so concurrent requests are multiplexed over persistent connections.
 
     Called by dundermain.
     """
-    results: list[dict[str, str | int | None]] = []
+    results: list[CollectionInfo] = []
     checked: int = 0
     start: int = 0
-    done: bool = False
-
-    with httpx.Client(timeout=10.0) as httpx_client:
-        while not done and checked < MAX_COLLECTIONS_TO_CHECK and len(results) < COLLECTIONS_TO_GATHER_SIZE:
-            batch: list[dict[str, str | None]] = fetch_collections_batch(httpx_client, server_root, start)
-            if not batch:
-                log.info('No more collections returned by server.')
-                break
-
-            for entry in batch:
-                summary: dict[str, str | None] = entry
-                if len(results) > COLLECTIONS_TO_GATHER_SIZE or checked >= MAX_COLLECTIONS_TO_CHECK:
-                    log.info('Enough small collections found or reached check limit, stopping.')
-                    done = True
-                    break
+    limiter: AsyncLimiter = AsyncLimiter(max_rate=1 / SLEEP_TIME, time_period=1.0)
+    cache: sqlite3.Connection | None = None
+    concurrency: int = INITIAL_CONCURRENCY
 
-                collection_id: str = summary['id']
-                name: str | None = summary.get('name')
-                time.sleep(SLEEP_TIME)
+    limits: httpx.Limits = httpx.Limits(max_keepalive_connections=MAX_CONNECTIONS, max_connections=MAX_CONNECTIONS)
+    ## http2 and limits go on the transport; the client ignores them when given a transport
+    transport: httpx.AsyncHTTPTransport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=CONNECT_RETRIES)
+    async with httpx.AsyncClient(transport=transport, timeout=10.0) as httpx_client:
+        ## the first page downloads while the faceted count query is in flight
+        next_batch_task: asyncio.Task[list[dict[str, str | None]]] | None = asyncio.create_task(
+            fetch_collections_batch(httpx_client, server_root, start)
+        )
+        try:
+            all_counts: dict[str, int] | None = None
+            try:
+                all_counts = await fetch_all_collection_counts(httpx_client, server_root)
+            except (httpx.HTTPError, ValueError) as e:  # ValueError covers a non-JSON (e.g. maintenance-page) body
+                log.warning(f'Faceted count query failed; falling back to per-collection queries: {e}')
+            if all_counts is None:
+                log.info('No facet counts available; using per-collection queries.')
                 try:
-                    count: int | None = fetch_collection_item_count(httpx_client, server_root, collection_id)
-                    if count is None:
-                        log.warning(f'No count returned for {collection_id}')
-                        continue
-                    log.info(f'Collection {collection_id}: {count} items')
-                    if MIN_ITEMS_CONSIDERED_SMALL <= count <= MAX_ITEMS_CONSIDERED_SMALL:
-                        result: dict[str, str | int | None] = {
-                            'id': collection_id,
-                            'name': name,
-                            'count': count,
-                        }
-                        results.append(result)
-                        log.info(f'Collection {collection_id} added to results (count: {count})')
-                except Exception as e:
-                    log.error(f'Error processing collection {collection_id}: {str(e)}')
-                checked += 1
+                    cache = open_count_cache(COUNT_CACHE_PATH)
+                except (OSError, sqlite3.Error) as e:
+                    log.warning(f'Could not open count cache at {COUNT_CACHE_PATH}; continuing uncached: {e}')
+
+            while next_batch_task is not None and checked < MAX_COLLECTIONS_TO_CHECK:
+                batch: list[dict[str, str | None]] = await next_batch_task
+                next_batch_task = None
+                if not batch:
+                    log.info('No more collections returned by server.')
+                    break
+                is_full_page: bool = len(batch) == COLLECTIONS_PER_BATCH_SIZE
 
-            start: int = start + COLLECTIONS_PER_BATCH_SIZE
+                ## limit the wave to the remaining check-allowance
+                batch = batch[: MAX_COLLECTIONS_TO_CHECK - checked]
+
+                ## prefetch the next page while this batch's counts are in flight
+                start: int = start + COLLECTIONS_PER_BATCH_SIZE
+                if is_full_page and checked + len(batch) < MAX_COLLECTIONS_TO_CHECK:
+                    next_batch_task = asyncio.create_task(fetch_collections_batch(httpx_client, server_root, start))
+
+                if all_counts is not None:
+                    for summary in batch:
+                        if len(results) >= COLLECTIONS_TO_GATHER_SIZE:
+                            break
+                        checked += 1
+                        ## collections absent from the facet list have no items
+                        evaluate_collection_count(summary, all_counts.get(summary['id'], 0), results)
+                else:
+                    batch_checked, concurrency = await check_batch_item_counts(
+                        httpx_client, limiter, cache, server_root, batch, results, concurrency
+                    )
+                    checked += batch_checked
+
+                if len(results) >= COLLECTIONS_TO_GATHER_SIZE:
+                    log.info('Enough small collections found, stopping.')
+                    break
+        finally:
+            ## drop a prefetched page that is no longer needed
+            if next_batch_task is not None:
+                next_batch_task.cancel()
+            if cache is not None:
+                cache.close()
 
     return results
 
@@ -151,9 +465,9 @@ def main() -> None:
     with a small number of items, and prints the ID, name, and item count for each found collection to stdout.
     """
     server_root: str = os.environ['SERVER_ROOT']
-    small_collection: list[dict[str, str | int | None]] = find_small_collections(server_root)
+    small_collection: list[CollectionInfo] = asyncio.run(find_small_collections(server_root))
     for info in small_collection:
-        print(f'{info["id"]} ({info["name"]!r}) has {info["count"]} items')
+        print(f'{info.id} ({info.name!r}) has {info.count} items')
 
 
 if __name__ == '__main__':